@@ -6,6 +6,10 @@ import random
 import os
 import time
 
+# CUDA stream for copying trained weights to the host, set up once per worker
+copy_stream = None
+
+
 class Client(object):
     """Simulated federated learning client."""
 
@@ -154,7 +158,20 @@ class Client(object):
 
 
         # Extract model weights and biases
-        weights = fl_model.extract_weights(self.model)
+        overlap = (self.do_test and copy_stream is not None
+                   and next(self.model.parameters()).is_cuda)
+        if overlap:
+            # Copy weights to pinned host memory on the side stream,
+            # overlapping the copy with testing on the default stream
+            copy_stream.wait_stream(torch.cuda.current_stream())
+            with torch.cuda.stream(copy_stream):
+                weights = [(name, torch.empty(weight.size(), dtype=weight.dtype,
+                                              pin_memory=True).copy_(
+                                                  weight.data, non_blocking=True))
+                           for name, weight in self.model.named_parameters()
+                           if weight.requires_grad]
+        else:
+            weights = fl_model.extract_weights(self.model)
 
         # Generate report for server
         self.report = Report(self)
@@ -167,6 +184,10 @@ class Client(object):
             testloader = fl_model.get_testloader(self.testset, 1000)
             self.report.accuracy = fl_model.test(self.model, testloader)
 
+        # Wait for weights to reach the host before reporting
+        if overlap:
+            copy_stream.synchronize()
+
     def test(self):
         # Perform model testing
         raise NotImplementedError
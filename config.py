@@ -43,15 +43,16 @@ class Config(object):
             self.loader = 'shard'
 
         # -- Federated learning --
-        fields = ['rounds', 'target_accuracy', 'task', 'epochs', 'batch_size']
-        defaults = (0, None, 'train', 0, 0)
+        fields = ['rounds', 'target_accuracy', 'task', 'epochs', 'batch_size',
+                  'eval_interval']
+        defaults = (0, None, 'train', 0, 0, 0)
         params = [config['federated_learning'].get(field, defaults[i])
                   for i, field in enumerate(fields)]
         self.fl = namedtuple('fl', fields)(*params)
 
         # -- Model --
-        fields = ['name', 'size']
-        defaults = ('MNIST', 1600)
+        fields = ['name', 'size', 'ckpt_fp16']
+        defaults = ('MNIST', 1600, False)
         params = [config['model'].get(field, defaults[i])
                   for i, field in enumerate(fields)]
         self.model = namedtuple('model', fields)(*params)
@@ -70,8 +71,8 @@ class Config(object):
         self.server = config['server']
 
         # -- Async --
-        fields = ['alpha', 'staleness_func']
-        defaults = (0.9, 'constant')
+        fields = ['alpha', 'staleness_func', 'keep_models']
+        defaults = (0.9, 'constant', None)
         params = [config['async'].get(field, defaults[i])
                   for i, field in enumerate(fields)]
         self.sync = namedtuple('sync', fields)(*params)
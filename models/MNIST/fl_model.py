@@ -1,3 +1,4 @@
+import inspect
 import load_data
 import logging
 import torch
@@ -5,9 +6,12 @@ import torch.nn as nn
 import torch.nn.functional as F
 import torch.optim as optim
 from torchvision import datasets, transforms
-import numpy as np
 import time
 
+# DataLoader keeps workers between iterations (torch >= 1.7)
+persistent_workers = 'persistent_workers' in inspect.signature(
+    torch.utils.data.DataLoader).parameters
+
 # Training settings
 lr = 0.01
 momentum = 0.9
@@ -68,8 +72,13 @@ def get_trainloader(trainset, batch_size):
     return torch.utils.data.DataLoader(trainset, batch_size=batch_size, shuffle=True)
 
 
-def get_testloader(testset, batch_size):
-    return torch.utils.data.DataLoader(testset, batch_size=batch_size, shuffle=True)
+def get_testloader(testset, batch_size, num_workers=0):
+    kwargs = {}
+    if num_workers > 0 and persistent_workers:  # Reuse workers across tests
+        kwargs = {'num_workers': num_workers, 'persistent_workers': True,
+                  'prefetch_factor': 4}
+    return torch.utils.data.DataLoader(testset, batch_size=batch_size, shuffle=True,
+                                       pin_memory=use_cuda, **kwargs)
 
 
 def extract_weights(model):
@@ -90,11 +99,8 @@ def load_weights(model, weights):
 
 def flatten_weights(weights):
     # Flatten weights into vectors
-    weight_vecs = []
-    for _, weight in weights:
-        weight_vecs.extend(weight.flatten().tolist())
-
-    return np.array(weight_vecs)
+    return torch.cat([weight.detach().reshape(-1)  # pylint: disable=no-member
+                      for _, weight in weights]).cpu().numpy()
 
 def train(model, trainloader, optimizer, epochs, reg=None):
     model.to(device)
@@ -1,5 +1,6 @@
 # pylint: skip-file
 
+import inspect
 import load_data
 import logging
 import torch
@@ -8,6 +9,10 @@ import torch.nn.functional as F
 import torch.optim as optim
 from torchvision import datasets, transforms
 
+# DataLoader keeps workers between iterations (torch >= 1.7)
+persistent_workers = 'persistent_workers' in inspect.signature(
+    torch.utils.data.DataLoader).parameters
+
 # Training settings
 lr = 0.01  # CHECKME
 momentum = 0.5  # CHECKME
@@ -51,8 +56,13 @@ def get_trainloader(trainset, batch_size):  # CHECKME
     return torch.utils.data.DataLoader(trainset, batch_size=batch_size, shuffle=True)
 
 
-def get_testloader(testset, batch_size):  # CHECKME
-    return torch.utils.data.DataLoader(testset, batch_size=batch_size, shuffle=True)
+def get_testloader(testset, batch_size, num_workers=0):  # CHECKME
+    kwargs = {}
+    if num_workers > 0 and persistent_workers:  # Reuse workers across tests
+        kwargs = {'num_workers': num_workers, 'persistent_workers': True,
+                  'prefetch_factor': 4}
+    return torch.utils.data.DataLoader(testset, batch_size=batch_size, shuffle=True,
+                                       **kwargs)
 
 
 def extract_weights(model):  # CHECKME
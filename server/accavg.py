@@ -12,10 +12,8 @@ class AccAvgServer(Server):
 
     # Report aggregation
     def accuracy_fed_avg(self, reports):
-        import fl_model  # pylint: disable=import-error
-
         # Extract updates from reports
-        updates = self.extract_client_updates(reports)
+        _, updates = self.extract_client_updates(reports)
 
         # Extract client accuracies
         accuracies = np.array([report.accuracy for report in reports])
@@ -24,23 +22,16 @@ class AccAvgServer(Server):
         factor = 8  # Exponentiation factor
         w = accuracies**factor / sum(accuracies**factor)
 
-        # Perform weighted averaging
-        avg_update = [torch.zeros(x.size())  # pylint: disable=no-member
-                      for _, x in updates[0]]
-        for i, update in enumerate(updates):
-            for j, (_, delta) in enumerate(update):
-                # Use weighted average by magnetude of updates
-                avg_update[j] += delta * w[i]
+        # Perform weighted averaging by accuracy of updates
+        w = torch.tensor(w, dtype=torch.float32,  # pylint: disable=no-member
+                         device=updates.device)
+        avg_update = w @ updates
 
         # Extract baseline model weights
-        baseline_weights = fl_model.extract_weights(self.model)
+        baseline = self.pack_weights(self.baseline_weights, updates.device)
 
         # Load updated weights into model
-        updated_weights = []
-        for i, (name, weight) in enumerate(baseline_weights):
-            updated_weights.append((name, weight + avg_update[i]))
-
-        return updated_weights
+        return self.unpack_weights(baseline + avg_update)
 
     # Server operations
     def set_client_data(self, client):
@@ -1,15 +1,20 @@
+import bisect
+import heapq
+from concurrent.futures import ThreadPoolExecutor
 import logging
 import pickle
-import random
 import math
-from threading import Thread
+import numpy as np
 import torch
 import time
-from queue import PriorityQueue
 import os
 from server import Server
 from network import Network
 from .record import Record, Profile
+from .server import run_client
+
+# Number of clients kept training while the server aggregates
+PIPELINE_DEPTH = 2
 
 
 class AsyncServer(Server):
@@ -25,6 +30,14 @@ class AsyncServer(Server):
 
         # Set up global model
         self.model = fl_model.Net()
+        # (time, path) of saved models sorted by time, including those
+        # left in the model directory by earlier runs
+        self.saved_models = self.list_models(model_path)
+
+        # Write models in the background, holding at most one pending model
+        self.save_executor = ThreadPoolExecutor(max_workers=1)
+        self.save_future = None
+        self.pending_model = None
         self.async_save_model(self.model, model_path, 0.0)
 
         # Extract flattened weights (if applicable)
@@ -36,12 +49,14 @@ class AsyncServer(Server):
         super().make_clients(num_clients)
 
         # Set link speed for clients
-        speed = []
         for client in self.clients:
             client.set_link(self.config)
-            speed.append(client.speed_mean)
 
-        logging.info('Speed distribution: {} Kbps'.format([s for s in speed]))
+        # Keep estimated client delays as an array indexed by client id
+        self.est_delays = np.array([client.est_delay for client in self.clients])
+
+        logging.info('Speed distribution: {} Kbps'.format(
+            [client.speed_mean for client in self.clients]))
 
         # Initiate client profile of loss and delay
         self.profile = Profile(num_clients)
@@ -57,12 +72,18 @@ class AsyncServer(Server):
         # Init async parameters
         self.alpha = self.config.sync.alpha
         self.staleness_func = self.config.sync.staleness_func
+        self.staleness_weight = {
+            "constant": self.constant_staleness,
+            "polynomial": self.polynomial_staleness,
+            "hinge": self.hinge_staleness
+        }[self.staleness_func]
 
         network = Network(self.config)  # create ns3 network/start ns3 program
         # dummy call to access
 
         # Init self accuracy records
         self.records = Record()
+        self.last_test_t = -math.inf
 
         if target_accuracy:
             logging.info('Training: {} rounds or {}% accuracy\n'.format(
@@ -102,6 +123,11 @@ class AsyncServer(Server):
                 pickle.dump(self.saved_reports, f)
             logging.info('Saved reports: {}'.format(reports_path))
 
+        # Finish writing models
+        self.flush_models()
+        self.save_executor.shutdown()
+        self.pool.shutdown()
+
         network.disconnect()
         f.close()
 
@@ -125,11 +151,19 @@ class AsyncServer(Server):
 
         T_new = T_old
         throughputs = []
+        # Heap of clients in training, ordered by aggregation time
+        pending = []
+        sim_finished = False
         # Start the asynchronous updates
         while True:
-            simdata = network.readAsyncResponse()
+            # Launch upcoming clients so they train during aggregation
+            while not sim_finished and len(pending) < PIPELINE_DEPTH:
+                simdata = network.readAsyncResponse()
+
+                if simdata == 'end':
+                    sim_finished = True
+                    break
 
-            if simdata != 'end':
                 #get the client/group based on the id, use map
                 client_id = -1
                 for key in simdata:
@@ -138,62 +172,77 @@ class AsyncServer(Server):
                 select_client = id_to_client[client_id][0]
                 select_client.delay = simdata[client_id]["endTime"]
                 T_client = id_to_client[client_id][1]
-                client_finished[client_id] = True
-                throughputs.append(simdata[client_id]["throughput"])
-
-                self.async_configuration([select_client], T_client)
-                select_client.run(reg=True)
                 T_cur = T_client + select_client.delay
-                T_new = T_cur
-
-                logging.info('Training finished on clients {} at time {} s'.format(
-                    select_client, T_cur
-                ))
-
-                # Receive client updates
-                reports = self.reporting([select_client])
 
-                # Update profile and plot
-                self.update_profile(reports)
+                future = self.async_launch(select_client, T_client)
+                heapq.heappush(pending, (T_cur, client_id, select_client,
+                                         simdata[client_id]["throughput"], future))
 
-                # Perform weight aggregation
-                logging.info('Aggregating updates from clients {}'.format(select_client))
-                staleness = select_client.delay
-                updated_weights = self.aggregation(reports, staleness)
-
-                # Load updated weights
-                fl_model.load_weights(self.model, updated_weights)
-
-                # Extract flattened weights (if applicable)
-                if self.config.paths.reports:
-                    self.save_reports(round, reports)
-
-                # Save updated global model
-                self.async_save_model(self.model, self.config.paths.model, T_cur)
-
-                # Test global model accuracy
-                if self.config.clients.do_test:  # Get average accuracy from client reports
-                    accuracy = self.accuracy_averaging(reports)
-                else:  # Test updated model on server
-                    testset = self.loader.get_testset()
-                    batch_size = self.config.fl.batch_size
-                    testloader = fl_model.get_testloader(testset, batch_size)
-                    accuracy = fl_model.test(self.model, testloader)
+            if not pending:
+                break
 
-                self.throughput = 0
-                if len(throughputs) > 0:
-                    self.throughput = sum([t for t in throughputs])/len(throughputs)
-                logging.info('Average accuracy: {:.2f}%\n'.format(100 * accuracy))
-                self.records.async_time_graphs(T_cur, accuracy, self.throughput)
+            # Wait for the earliest client to finish training
+            T_cur, client_id, select_client, throughput, future = heapq.heappop(pending)
+            self.receive_report(select_client, future.result())
+            client_finished[client_id] = True
+            throughputs.append(throughput)
+            T_new = T_cur
+
+            logging.info('Training finished on clients {} at time {} s'.format(
+                select_client, T_cur
+            ))
+
+            # Receive client updates
+            reports = self.reporting([select_client])
+
+            # Update profile and plot
+            self.update_profile(reports)
+
+            # Refresh cached baseline weights without moving the model,
+            # as saving reports or testing may have moved it since last update
+            self.baseline_weights = [(name, weight.data)
+                                     for name, weight in self.model.named_parameters()
+                                     if weight.requires_grad]
+
+            # Perform weight aggregation into the global model
+            logging.info('Aggregating updates from clients {}'.format(select_client))
+            staleness = select_client.delay
+            self.aggregation(reports, staleness)
+
+            # Extract flattened weights (if applicable)
+            if self.config.paths.reports:
+                self.save_reports(round, reports)
+
+            # Save updated global model
+            self.async_save_model(self.model, self.config.paths.model, T_cur)
+
+            # Test global model accuracy
+            eval_interval = self.config.fl.eval_interval
+            last_update = sim_finished and not pending
+            if self.config.clients.do_test:  # Get average accuracy from client reports
+                accuracy = self.accuracy_averaging(reports)
+            elif last_update or T_cur - self.last_test_t >= eval_interval:
+                # Test updated model on server every eval_interval secs
+                accuracy = fl_model.test(self.model, self.testloader)
+                self.last_test_t = T_cur
+            else:  # Reuse latest accuracy between server tests
+                accuracy = self.records.get_latest_acc()
+
+            self.throughput = 0
+            if len(throughputs) > 0:
+                self.throughput = sum([t for t in throughputs])/len(throughputs)
+            logging.info('Average accuracy: {:.2f}%\n'.format(100 * accuracy))
+            self.records.async_time_graphs(T_cur, accuracy, self.throughput)
 
             # Return when target accuracy is met
-                if target_accuracy and \
-                        (self.records.get_latest_acc() >= target_accuracy):
-                    logging.info('Target accuracy reached.')
-                    break
-            elif simdata == 'end':
+            if target_accuracy and \
+                    (self.records.get_latest_acc() >= target_accuracy):
+                logging.info('Target accuracy reached.')
                 break
 
+        # Drop clients still in training when the round ends early
+        for entry in pending:
+            entry[-1].cancel()
 
         logging.info('Round lasts {} secs, avg throughput {} kB/s'.format(
             T_new, self.throughput
@@ -217,31 +266,30 @@ class AsyncServer(Server):
 
         if select_type == 'random':
             # Select clients randomly
-            sample_clients = [client for client in random.sample(
-                self.clients, clients_per_round)]
+            sample_idx = self.rng.choice(
+                len(self.clients), clients_per_round, replace=False)
+            sample_clients = [self.clients[i] for i in sample_idx]
 
         elif select_type == 'short_latency_first':
             # Select the clients with short latencies and random loss
-            sample_clients = sorted(self.clients, key=lambda c:c.est_delay)
-            sample_clients = sample_clients[:clients_per_round]
+            sorted_idx = np.argsort(self.est_delays, kind='stable')
+            sample_clients = [self.clients[i] for i in sorted_idx[:clients_per_round]]
             print(sample_clients)
 
         elif select_type == 'short_latency_high_loss_first':
             # Get the non-negative losses and delays
-            losses = [c.loss for c in self.clients]
-            losses_norm = [l/max(losses) for l in losses]
-            delays = [c.est_delay for c in self.clients]
-            delays_norm = [d/max(losses) for d in delays]
+            losses = self.losses
+            losses_norm = losses / losses.max()
+            delays = self.est_delays
+            delays_norm = delays / losses.max()
 
             # Sort the clients by jointly consider latency and loss
             gamma = 0.2
-            sorted_idx = sorted(range(len(self.clients)),
-                                key=lambda i: losses_norm[i] - gamma * delays_norm[i],
-                                reverse=True)
-            print([losses[i] for i in sorted_idx])
-            print([delays[i] for i in sorted_idx])
-            sample_clients = [self.clients[i] for i in sorted_idx]
-            sample_clients = sample_clients[:clients_per_round]
+            sorted_idx = np.argsort(-(losses_norm - gamma * delays_norm),
+                                    kind='stable')
+            print(losses[sorted_idx].tolist())
+            print(delays[sorted_idx].tolist())
+            sample_clients = [self.clients[i] for i in sorted_idx[:clients_per_round]]
             print(sample_clients)
 
         # Create one group for each selected client to perform async updates
@@ -269,6 +317,11 @@ class AsyncServer(Server):
             # Continue configuration on client
             client.async_configure(config, download_time)
 
+    def async_launch(self, select_client, download_time):
+        # Configure client and start its training in a worker process
+        self.async_configuration([select_client], download_time)
+        return self.pool.submit(run_client, select_client, True)
+
     def aggregation(self, reports, staleness=None):
         return self.federated_async(reports, staleness)
 
@@ -279,25 +332,22 @@ class AsyncServer(Server):
         return weights
 
     def federated_async(self, reports, staleness):
-        import fl_model  # pylint: disable=import-error
+        # Keep aggregation on the device of the model
+        device = self.params[0].device
 
-        # Extract updates from reports
+        # Extract weights from reports
         weights = self.extract_client_weights(reports)
 
-        # Extract total number of samples
-        total_samples = sum([report.num_samples for report in reports])
-
-        # Perform weighted averaging
-        new_weights = [torch.zeros(x.size())  # pylint: disable=no-member
-                      for _, x in weights[0]]
-        for i, update in enumerate(weights):
-            num_samples = reports[i].num_samples
-            for j, (_, weight) in enumerate(update):
-                # Use weighted average by number of samples
-                new_weights[j] += weight * (num_samples / total_samples)
-
-        # Extract baseline model weights - latest model
-        baseline_weights = fl_model.extract_weights(self.model)
+        # Perform weighted averaging by number of samples,
+        # streaming one client at a time through the scratch buffer
+        new_weights = torch.zeros(  # pylint: disable=no-member
+            sum(self.weight_numels), device=device)
+        scales = self.sample_weights(reports)
+        for scale, weight in zip(scales, weights):
+            self.check_layout(weight)
+            new_weights.add_(self.pack_weights(
+                weight, device, out=self.scratch_buffer(device)), alpha=scale)
+        new_weights = [weight for _, weight in self.unpack_weights(new_weights)]
 
         # Calculate the staleness-aware weights
         alpha_t = self.alpha * self.staleness(staleness)
@@ -305,43 +355,103 @@ class AsyncServer(Server):
             self.staleness_func, staleness, alpha_t
         ))
 
-        # Load updated weights into model
-        updated_weights = []
-        for i, (name, weight) in enumerate(baseline_weights):
-            updated_weights.append(
-                (name, (1 - alpha_t) * weight + alpha_t * new_weights[i])
-            )
-
-        return updated_weights
+        # Update latest model weights in place,
+        # (1 - alpha_t) * weight + alpha_t * new_weight in one pass
+        with torch.no_grad():
+            for param, new_weight in zip(self.params, new_weights):
+                param.lerp_(new_weight, alpha_t)
 
     def staleness(self, staleness):
-        if self.staleness_func == "constant":
+        # Staleness function is resolved once in run()
+        return self.staleness_weight(staleness)
+
+    @staticmethod
+    def constant_staleness(staleness):
+        return 1
+
+    @staticmethod
+    def polynomial_staleness(staleness):
+        # Polynomial with a = 0.5, i.e. (staleness + 1)^-0.5
+        return 1 / math.sqrt(staleness + 1)
+
+    @staticmethod
+    def hinge_staleness(staleness):
+        a, b = 10, 4
+        if staleness <= b:
             return 1
-        elif self.staleness_func == "polynomial":
-            a = 0.5
-            return pow(staleness+1, -a)
-        elif self.staleness_func == "hinge":
-            a, b = 10, 4
-            if staleness <= b:
-                return 1
-            else:
-                return 1 / (a * (staleness - b) + 1)
+        else:
+            return 1 / (a * (staleness - b) + 1)
 
     def async_save_model(self, model, path, download_time):
         path += '/global_' + '{}'.format(download_time)
-        torch.save(model.state_dict(), path)
+
+        # Snapshot weights, since the model changes while it is written
+        if self.config.model.ckpt_fp16:
+            state = self.half_state(model.state_dict())
+        else:
+            state = {name: weight.detach().to('cpu', copy=True)
+                     for name, weight in model.state_dict().items()}
+
+        if self.save_future is not None and not self.save_future.done():
+            # Writer is busy, replace any older model waiting to be written
+            self.pending_model = (state, path, download_time)
+        else:
+            self.pending_model = None
+            self.save_future = self.save_executor.submit(
+                self.write_model, state, path, download_time)
+
+    def write_model(self, state, path, download_time):
+        torch.save(state, path)
         logging.info('Saved global model: {}'.format(path))
 
-    def rm_old_models(self, path, cur_time):
+        # Track saved model
+        newest = bisect.bisect_left(self.saved_models, (download_time, path))
+        if newest == len(self.saved_models) or \
+                self.saved_models[newest] != (download_time, path):
+            self.saved_models.insert(newest, (download_time, path))
+
+        # Rotate models saved during the round, keeping the first one
+        # since clients of the round download it, and the newest one
+        # since clients of the next round download it
+        keep_models = self.config.sync.keep_models
+        if keep_models is not None:
+            while newest > max(keep_models, 1):
+                _, old_path = self.saved_models.pop(1)
+                os.remove(old_path)
+                logging.info('Remove model {}'.format(old_path))
+                newest -= 1
+
+    @staticmethod
+    def list_models(path):
+        # Parse (time, path) of models in the model directory
+        models = []
         for filename in os.listdir(path):
             try:
                 model_time = float(filename.split('_')[1])
-                if model_time < cur_time:
-                    os.remove(os.path.join(path, filename))
-                    logging.info('Remove model {}'.format(filename))
-            except Exception as e:
-                logging.debug(e)
+            except (IndexError, ValueError):
                 continue
+            models.append((model_time, os.path.join(path, filename)))
+
+        return sorted(models)
+
+    def flush_models(self):
+        # Wait for the writer, then write the newest pending model
+        if self.save_future is not None:
+            self.save_future.result()
+        if self.pending_model is not None:
+            self.write_model(*self.pending_model)
+            self.pending_model = None
+
+    def rm_old_models(self, path, cur_time):
+        # Make sure the model clients download is on disk
+        self.flush_models()
+
+        # Remove models saved before the current time
+        old = bisect.bisect_left(self.saved_models, (cur_time,))
+        for _, old_path in self.saved_models[:old]:
+            os.remove(old_path)
+            logging.info('Remove model {}'.format(old_path))
+        self.saved_models = self.saved_models[old:]
 
     def update_profile(self, reports):
         for report in reports:
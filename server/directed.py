@@ -1,7 +1,6 @@
 import logging
 from server import Server
 import numpy as np
-from threading import Thread
 
 
 class DirectedServer(Server):
@@ -17,8 +16,6 @@ class DirectedServer(Server):
 
     # Federated learning phases
     def selection(self):
-        import fl_model  # pylint: disable=import-error
-
         clients = self.clients
         clients_per_round = self.config.clients.per_round
         profiles = self.profiles
@@ -28,7 +25,7 @@ class DirectedServer(Server):
         directors = [d for _, d in profiles]
 
         # Extract most recent model weights
-        w_current = self.flatten_weights(fl_model.extract_weights(self.model))
+        w_current = self.flatten_weights(self.baseline_weights)
         model_direction = w_current - w_previous
         # Normalize model direction
         model_direction = model_direction / \
@@ -70,9 +67,7 @@ class DirectedServer(Server):
         self.configuration(clients)
 
         # Train on clients to generate profile weights
-        threads = [Thread(target=client.train) for client in self.clients]
-        [t.start() for t in threads]
-        [t.join() for t in threads]
+        self.run_clients(clients)
 
         # Recieve client reports
         reports = self.reporting(clients)
@@ -82,7 +77,7 @@ class DirectedServer(Server):
         weights = [self.flatten_weights(weight) for weight in weights]
 
         # Extract initial model weights
-        w0 = self.flatten_weights(fl_model.extract_weights(self.model))
+        w0 = self.flatten_weights(self.baseline_weights)
 
         # Save as initial previous model weights
         self.w_previous = w0.copy()
@@ -94,6 +89,7 @@ class DirectedServer(Server):
 
         # Load updated weights
         fl_model.load_weights(self.model, updated_weights)
+        self.baseline_weights = fl_model.extract_weights(self.model)
 
         # Calculate direction vectors (directors)
         directors = [(w - w0) for w in weights]
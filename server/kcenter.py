@@ -1,7 +1,6 @@
 import logging
 import random
 from server import Server
-from threading import Thread
 from utils.kcenter import GreedyKCenter  # pylint: disable=no-name-in-module
 
 
@@ -63,9 +62,7 @@ class KCenterServer(Server):
         self.configuration(clients)
 
         # Train on clients to generate profile weights
-        threads = [Thread(target=client.train) for client in self.clients]
-        [t.start() for t in threads]
-        [t.join() for t in threads]
+        self.run_clients(clients)
 
         # Recieve client reports
         reports = self.reporting(clients)
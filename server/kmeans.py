@@ -2,7 +2,6 @@ import logging
 import random
 from server import Server
 from sklearn.cluster import KMeans
-from threading import Thread
 import utils.dists as dists  # pylint: disable=no-name-in-module
 
 
@@ -49,9 +48,7 @@ class KMeansServer(Server):
         self.configuration(clients)
 
         # Train on local data for profiling purposes
-        threads = [Thread(target=client.train) for client in self.clients]
-        [t.start() for t in threads]
-        [t.join() for t in threads]
+        self.run_clients(clients)
 
         # Recieve client reports
         reports = self.reporting(clients)
@@ -1,15 +1,33 @@
 import client
+from concurrent.futures import ProcessPoolExecutor
 import load_data
 import logging
 import numpy as np
+import os
 import pickle
 import random
 import sys
-from threading import Thread
 import torch
+import torch.multiprocessing as mp
 import utils.dists as dists  # pylint: disable=no-name-in-module
 
 
+def init_worker():
+    # Avoid oversubscribing cores with one process per client
+    torch.set_num_threads(1)
+    mp.set_sharing_strategy('file_system')
+
+    # One side stream per worker for copying trained weights to the host
+    if torch.cuda.is_available():
+        client.copy_stream = torch.cuda.Stream()
+
+
+def run_client(client, reg=None):
+    # Run client in a worker process and send back its report
+    client.run(reg)
+    return client.report
+
+
 class Server(object):
     """Basic federated learning server."""
 
@@ -26,9 +44,22 @@ class Server(object):
         # Add fl_model to import path
         sys.path.append(model_path)
 
+        # Set up worker processes for running clients, one per client at most
+        # since each training worker builds its own CUDA context
+        mp.set_sharing_strategy('file_system')
+        max_workers = min(os.cpu_count(), self.config.clients.per_round)
+        self.pool = ProcessPoolExecutor(max_workers=max_workers,
+                                        mp_context=mp.get_context('spawn'),
+                                        initializer=init_worker)
+
+        # Set up random generator for batched sampling
+        self.rng = np.random.RandomState()
+
         # Set up simulated server
         self.load_data()
         self.load_model()
+        self.load_schema()
+        self.load_testloader()
         self.make_clients(total_clients)
 
     def load_data(self):
@@ -77,6 +108,34 @@ class Server(object):
             self.saved_reports = {}
             self.save_reports(0, [])  # Save initial model
 
+    def load_schema(self):
+        import fl_model  # pylint: disable=import-error
+
+        # Cache baseline model weights, refreshed whenever they are loaded
+        self.baseline_weights = fl_model.extract_weights(self.model)
+
+        # Record the layout of model weights for flattened aggregation
+        self.weight_shapes = [(name, weight.size())
+                              for name, weight in self.baseline_weights]
+        self.weight_numels = [weight.numel()
+                              for _, weight in self.baseline_weights]
+
+        # Keep model parameters for in-place updates
+        self.params = [param for param in self.model.parameters()
+                       if param.requires_grad]
+
+        # Scratch buffer for streaming client weights through aggregation
+        self.weight_buf = None
+
+    def load_testloader(self):
+        import fl_model  # pylint: disable=import-error
+
+        # Set up server testloader once for all rounds
+        testset = self.loader.get_testset()
+        batch_size = self.config.fl.batch_size
+        self.testloader = fl_model.get_testloader(
+            testset, batch_size, num_workers=os.cpu_count() // 2)
+
     def make_clients(self, num_clients):
         IID = self.config.data.IID
         labels = self.loader.labels
@@ -88,7 +147,11 @@ class Server(object):
                 "uniform": dists.uniform(num_clients, len(labels)),
                 "normal": dists.normal(num_clients, len(labels))
             }[self.config.clients.label_distribution]
-            random.shuffle(dist)  # Shuffle distribution
+            self.rng.shuffle(dist)  # Shuffle distribution
+
+            # Choose weighted random preferences for all clients at once
+            prefs = self.rng.choice(len(labels), size=num_clients,
+                                    p=np.asarray(dist) / np.sum(dist))
 
         # Make simulated clients
         clients = []
@@ -101,11 +164,8 @@ class Server(object):
                 if self.config.data.bias:
                     # Bias data partitions
                     bias = self.config.data.bias
-                    # Choose weighted random preference
-                    pref = random.choices(labels, dist)[0]
-
                     # Assign preference, bias config
-                    new_client.set_bias(pref, bias)
+                    new_client.set_bias(labels[prefs[client_id]], bias)
                 elif self.config.data.shard:
                     # Shard data partitions
                     shard = self.config.data.shard
@@ -130,6 +190,9 @@ class Server(object):
 
         self.clients = clients
 
+        # Keep client losses as an array indexed by client id
+        self.losses = np.array([client.loss for client in clients])
+
     # Run federated learning
     def run(self):
         rounds = self.config.fl.rounds
@@ -159,6 +222,8 @@ class Server(object):
                 pickle.dump(self.saved_reports, f)
             logging.info('Saved reports: {}'.format(reports_path))
 
+        self.pool.shutdown()
+
     def round(self):
         import fl_model  # pylint: disable=import-error
 
@@ -168,10 +233,8 @@ class Server(object):
         # Configure sample clients
         self.configuration(sample_clients)
 
-        # Run clients using multithreading for better parallelism
-        threads = [Thread(target=client.run) for client in sample_clients]
-        [t.start() for t in threads]
-        [t.join() for t in threads]
+        # Run clients using multiprocessing for better parallelism
+        self.run_clients(sample_clients)
 
         # Recieve client updates
         reports = self.reporting(sample_clients)
@@ -182,6 +245,7 @@ class Server(object):
 
         # Load updated weights
         fl_model.load_weights(self.model, updated_weights)
+        self.baseline_weights = fl_model.extract_weights(self.model)
 
         # Extract flattened weights (if applicable)
         if self.config.paths.reports:
@@ -194,10 +258,7 @@ class Server(object):
         if self.config.clients.do_test:  # Get average accuracy from client reports
             accuracy = self.accuracy_averaging(reports)
         else:  # Test updated model on server
-            testset = self.loader.get_testset()
-            batch_size = self.config.fl.batch_size
-            testloader = fl_model.get_testloader(testset, batch_size)
-            accuracy = fl_model.test(self.model, testloader)
+            accuracy = fl_model.test(self.model, self.testloader)
 
         logging.info('Average accuracy: {:.2f}%\n'.format(100 * accuracy))
         return accuracy
@@ -209,8 +270,9 @@ class Server(object):
         clients_per_round = self.config.clients.per_round
 
         # Select clients randomly
-        sample_clients = [client for client in random.sample(
-            self.clients, clients_per_round)]
+        sample_idx = self.rng.choice(
+            len(self.clients), clients_per_round, replace=False)
+        sample_clients = [self.clients[i] for i in sample_idx]
 
         return sample_clients
 
@@ -234,6 +296,21 @@ class Server(object):
             # Continue configuraion on client
             client.configure(config)
 
+    def run_clients(self, sample_clients, reg=None):
+        # Run clients in worker processes
+        reports = self.pool.map(run_client, sample_clients,
+                                [reg] * len(sample_clients))
+
+        # Keep client state in sync with worker results
+        for client, report in zip(sample_clients, reports):
+            self.receive_report(client, report)
+
+    def receive_report(self, client, report):
+        # Store report of a client trained in a worker process
+        client.report = report
+        client.loss = report.loss
+        self.losses[client.client_id] = report.loss
+
     def reporting(self, sample_clients):
         # Recieve reports from sample clients
         reports = [client.get_report() for client in sample_clients]
@@ -248,58 +325,46 @@ class Server(object):
 
     # Report aggregation
     def extract_client_updates(self, reports):
-        import fl_model  # pylint: disable=import-error
+        # Keep updates on the device of the model
+        device = self.params[0].device
 
         # Extract baseline model weights
-        baseline_weights = fl_model.extract_weights(self.model)
+        baseline = self.pack_weights(self.baseline_weights, device)
 
-        # Extract weights from reports
-        weights = [report.weights for report in reports]
+        # Extract weights from reports, one row per client
+        updates = self.stack_weights(
+            [report.weights for report in reports], device)
 
         # Calculate updates from weights
-        updates = []
-        for weight in weights:
-            update = []
-            for i, (name, weight) in enumerate(weight):
-                bl_name, baseline = baseline_weights[i]
+        updates.sub_(baseline)
 
-                # Ensure correct weight is being updated
-                assert name == bl_name
-
-                # Calculate update
-                delta = weight - baseline
-                update.append((name, delta))
-            updates.append(update)
-
-        return updates
+        return self.weight_shapes, updates
 
     def federated_averaging(self, reports):
-        import fl_model  # pylint: disable=import-error
-
-        # Extract updates from reports
-        updates = self.extract_client_updates(reports)
-
-        # Extract total number of samples
-        total_samples = sum([report.num_samples for report in reports])
-
-        # Perform weighted averaging
-        avg_update = [torch.zeros(x.size())  # pylint: disable=no-member
-                      for _, x in updates[0]]
-        for i, update in enumerate(updates):
-            num_samples = reports[i].num_samples
-            for j, (_, delta) in enumerate(update):
-                # Use weighted average by number of samples
-                avg_update[j] += delta * (num_samples / total_samples)
+        # Keep aggregation on the device of the model
+        device = self.params[0].device
 
         # Extract baseline model weights
-        baseline_weights = fl_model.extract_weights(self.model)
+        baseline = self.pack_weights(self.baseline_weights, device)
+
+        # Perform weighted averaging by number of samples,
+        # streaming one client update at a time through the scratch buffer
+        avg_update = torch.zeros_like(baseline)  # pylint: disable=no-member
+        scales = self.sample_weights(reports)
+        for scale, report in zip(scales, reports):
+            self.check_layout(report.weights)
+            delta = self.pack_weights(report.weights, device,
+                                      out=self.scratch_buffer(device))
+            delta.sub_(baseline)
+            avg_update.add_(delta, alpha=scale)
 
         # Load updated weights into model
-        updated_weights = []
-        for i, (name, weight) in enumerate(baseline_weights):
-            updated_weights.append((name, weight + avg_update[i]))
+        return self.unpack_weights(avg_update.add_(baseline))
 
-        return updated_weights
+    def sample_weights(self, reports):
+        # Weigh reports by their share of the total number of samples
+        total_samples = sum([report.num_samples for report in reports])
+        return [report.num_samples / total_samples for report in reports]
 
     def accuracy_averaging(self, reports):
         # Get total number of samples
@@ -313,14 +378,43 @@ class Server(object):
         return accuracy
 
     # Server operations
+    @staticmethod
+    def pack_weights(weights, device=torch.device('cpu'), out=None):  # pylint: disable=no-member
+        # Pack weights into a single contiguous vector on device
+        return torch.cat([weight.to(device, non_blocking=True).reshape(-1)  # pylint: disable=no-member
+                          for _, weight in weights], out=out)
+
+    def check_layout(self, weights):
+        # Ensure weights follow the model layout
+        assert [name for name, _ in weights] == \
+            [name for name, _ in self.weight_shapes]
+
+    def scratch_buffer(self, device):
+        # Reuse one packed weights buffer across clients and aggregations
+        if self.weight_buf is None or self.weight_buf.device != device:
+            self.weight_buf = torch.empty(  # pylint: disable=no-member
+                sum(self.weight_numels), device=device)
+        return self.weight_buf
+
+    def stack_weights(self, weights_list, device=torch.device('cpu')):  # pylint: disable=no-member
+        # Stack packed weights of several models into one matrix
+        for weights in weights_list:
+            self.check_layout(weights)
+
+        return torch.stack([self.pack_weights(weights, device)  # pylint: disable=no-member
+                            for weights in weights_list])
+
+    def unpack_weights(self, vector):
+        # Unpack a weight vector into named weights of the model layout
+        chunks = torch.split(vector, self.weight_numels)  # pylint: disable=no-member
+        return [(name, chunk.view(shape)) for (name, shape), chunk
+                in zip(self.weight_shapes, chunks)]
+
     @staticmethod
     def flatten_weights(weights):
         # Flatten weights into vectors
-        weight_vecs = []
-        for _, weight in weights:
-            weight_vecs.extend(weight.flatten().tolist())
-
-        return np.array(weight_vecs)
+        return torch.cat([weight.detach().reshape(-1)  # pylint: disable=no-member
+                          for _, weight in weights]).cpu().numpy()
 
     def set_client_data(self, client):
         loader = self.config.loader
@@ -346,9 +440,19 @@ class Server(object):
         # Send data to client
         client.set_data(data, self.config)
 
+    @staticmethod
+    def half_state(state):
+        # Copy state to CPU, storing floating point weights in half precision
+        return {name: weight.detach().to('cpu', torch.float16, copy=True)  # pylint: disable=no-member
+                if weight.is_floating_point() else weight.detach().to('cpu', copy=True)
+                for name, weight in state.items()}
+
     def save_model(self, model, path):
         path += '/global'
-        torch.save(model.state_dict(), path)
+        state = model.state_dict()
+        if self.config.model.ckpt_fp16:
+            state = self.half_state(state)
+        torch.save(state, path)
         logging.info('Saved global model: {}'.format(path))
 
     def save_reports(self, round, reports):
@@ -1,9 +1,8 @@
 import logging
 import pickle
-import random
 import math
+import numpy as np
 import time
-from threading import Thread
 from server import Server
 from network import Network
 from .record import Record, Profile
@@ -56,12 +55,15 @@ class SyncServer(Server):
         super().make_clients(num_clients)
 
         # Set link speed for clients
-        speed = []
         for client in self.clients:
             client.set_link(self.config)
-            speed.append(client.speed_mean)
 
-        logging.info('Speed distribution: {} Kbps'.format([s for s in speed]))
+        # Keep link attributes of clients as arrays indexed by client id
+        self.est_delays = np.array([client.est_delay for client in self.clients])
+        self.delays = np.zeros(num_clients)
+
+        logging.info('Speed distribution: {} Kbps'.format(
+            [client.speed_mean for client in self.clients]))
 
         # Initiate client profile of loss and delay
         self.profile = Profile(num_clients)
@@ -111,6 +113,7 @@ class SyncServer(Server):
                 pickle.dump(self.saved_reports, f)
             logging.info('Saved reports: {}'.format(reports_path))
 
+        self.pool.shutdown()
         network.disconnect()
 
     def sync_round(self, round, T_old, network):
@@ -119,7 +122,6 @@ class SyncServer(Server):
         # Select clients to participate in the round
         sample_groups = self.selection(network)
         sample_clients, throughput = [], []
-        delays = []
         dropouts = 0
         for group in sample_groups:
             parsed_clients = network.parse_clients(group.clients)
@@ -133,7 +135,8 @@ class SyncServer(Server):
                     continue
                 client.est_delay = simdata[client.client_id]["roundTime"]
                 client.delay = simdata[client.client_id]["roundTime"]
-                delays.append(simdata[client.client_id]["roundTime"])
+                self.est_delays[client.client_id] = client.est_delay
+                self.delays[client.client_id] = client.delay
                 sample_clients.append(client)
                 throughput.append(simdata[client.client_id]["throughput"])
             group.set_download_time(T_old)
@@ -152,14 +155,13 @@ class SyncServer(Server):
 
         # Use the max delay in all sample clients as the delay in sync round
         # delays = network.access_network(sample_clients)
-        print(delays)
-        max_delay = max(delays)  # access latency from ns3 simulation
+        sample_idx = [client.client_id for client in sample_clients]
+        print(self.delays[sample_idx].tolist())
+        max_delay = self.delays[sample_idx].max()  # access latency from ns3 simulation
         print(max_delay)
 
-        # Run clients using multithreading for better parallelism
-        threads = [Thread(target=client.run) for client in sample_clients]
-        [t.start() for t in threads]
-        [t.join() for t in threads]
+        # Run clients using multiprocessing for better parallelism
+        self.run_clients(sample_clients)
         T_cur = T_old + max_delay  # Update current time
 
         # Receive client updates
@@ -178,6 +180,7 @@ class SyncServer(Server):
 
         # Load updated weights
         fl_model.load_weights(self.model, updated_weights)
+        self.baseline_weights = fl_model.extract_weights(self.model)
 
         # Extract flattened weights (if applicable)
         if self.config.paths.reports:
@@ -190,10 +193,7 @@ class SyncServer(Server):
         if self.config.clients.do_test:  # Get average accuracy from client reports
             accuracy = self.accuracy_averaging(reports)
         else:  # Test updated model on server
-            testset = self.loader.get_testset()
-            batch_size = self.config.fl.batch_size
-            testloader = fl_model.get_testloader(testset, batch_size)
-            accuracy = fl_model.test(self.model, testloader)
+            accuracy = fl_model.test(self.model, self.testloader)
 
         logging.info('Average accuracy: {:.2f}%'.format(100 * accuracy))
         self.records.append_record(T_cur, accuracy, self.throughput, dropouts, round)
@@ -206,39 +206,38 @@ class SyncServer(Server):
 
         if select_type == 'random':
         # Select clients randomly
-            sample_clients = [client for client in random.sample(
-                self.clients, clients_per_round)]
+            sample_idx = self.rng.choice(
+                len(self.clients), clients_per_round, replace=False)
+            sample_clients = [self.clients[i] for i in sample_idx]
             print("random")
 
         elif select_type == 'short_latency_first':
             # Select the clients with short latencies and random loss
-            sample_clients = sorted(self.clients, key=lambda c:c.est_delay)
-            sample_clients = sample_clients[:clients_per_round]
+            sorted_idx = np.argsort(self.est_delays, kind='stable')
+            sample_clients = [self.clients[i] for i in sorted_idx[:clients_per_round]]
             print(select_type)
 
         elif select_type == 'high_loss_first':
             # Select the clients with random latencies and high loss
-            sample_clients = sorted(self.clients, key=lambda c:c.loss, reverse = True)
-            sample_clients = sample_clients[:clients_per_round]
+            sorted_idx = np.argsort(-self.losses, kind='stable')
+            sample_clients = [self.clients[i] for i in sorted_idx[:clients_per_round]]
             print(select_type)
 
         elif select_type == 'short_latency_high_loss_first':
             # Get the non-negative losses and delays
-            losses = [c.loss for c in self.clients]
-            losses_norm = [l/max(losses) for l in losses]
-            delays = [c.est_delay for c in self.clients]
-            delays_norm = [d/max(losses) for d in delays]
+            losses = self.losses
+            losses_norm = losses / losses.max()
+            delays = self.est_delays
+            delays_norm = delays / losses.max()
 
             # Sort the clients by jointly consider latency and loss
             gamma = 0.2
             #0.2 for mnist
-            sorted_idx = sorted(range(len(self.clients)),
-                                key=lambda i: losses_norm[i] - gamma * delays_norm[i],
-                                reverse=True)
-            print([losses[i] for i in sorted_idx])
-            print([delays[i] for i in sorted_idx])
-            sample_clients = [self.clients[i] for i in sorted_idx]
-            sample_clients = sample_clients[:clients_per_round]
+            sorted_idx = np.argsort(-(losses_norm - gamma * delays_norm),
+                                    kind='stable')
+            print(losses[sorted_idx].tolist())
+            print(delays[sorted_idx].tolist())
+            sample_clients = [self.clients[i] for i in sorted_idx[:clients_per_round]]
             print(select_type)
         # In sync case, create one group of all selected clients
         sample_groups = [Group([client for client in sample_clients])]